@@ -2,54 +2,105 @@
 import os
 import uuid
 import sys
-from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient, PublicAccess
+import asyncio
+from azure.storage.blob.aio import BlobServiceClient
 from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
 
-def run_sample(azs_storage):
+MAX_INFLIGHT_DOWNLOADS = 8
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+def _open_part_file(path):
+    # Create the temporary file with mode 0666 so the process umask applies as with open()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+    return os.fdopen(fd, 'wb', buffering=WRITE_BUFFER_SIZE)
+
+async def _run_blocking(func, *args):
+    # Run file system calls in the default executor so disk I/O does not stall other downloads
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+async def _fetch_blob(container_client, sem, blob_name, dest):
+    # Derive the blob client from its container to reuse the parent pipeline
+    blob_client = container_client.get_blob_client(blob_name)
+    # Download into a temporary file next to the destination and publish it with an
+    # atomic rename, so a failed download never leaves a partial image in the gallery
+    async with sem:
+        tmp_path = dest + '.' + uuid.uuid4().hex + '.part'
+        file = await _run_blocking(_open_part_file, tmp_path)
+        published = False
+        try:
+            try:
+                # Stream the blob chunks straight into a large buffered file instead of readall()
+                downloader = await blob_client.download_blob(max_concurrency=4)
+                async for chunk in downloader.chunks():
+                    await _run_blocking(file.write, chunk)
+            finally:
+                await _run_blocking(file.close)
+            await _run_blocking(os.replace, tmp_path, dest)
+            published = True
+        except ResourceNotFoundError:
+            print("No blob found.")
+        finally:
+            if not published:
+                await _run_blocking(os.unlink, tmp_path)
+
+async def run_sample_async(azs_storage):
     try:
         # Create the BlobServiceClient that is used to call the Blob service for the storage account
         conn_str = azs_storage
-        blob_service_client = BlobServiceClient.from_connection_string(conn_str=conn_str)
-        # List the containers in the Storage Account and blobs in the container
-        all_containers = blob_service_client.list_containers(include_metadata=True)
-        # Create Sample folder if it not exists, and create a file in folder Sample to test the upload and download.
-        local_path = os.path.join(os.path.expanduser("~"),'Face_Gallery')
-        if not os.path.exists(local_path):
-            os.makedirs(local_path)
-            print("[ DEBUG ] Make " + local_path)
-
-
-        for container in all_containers:
-            print(container['name'], container['metadata'])
-            print("\nList blobs in the container")
-            container_id = blob_service_client.get_container_client(container=container['name'])
-            generator = container_id.list_blobs()
-            for blob in generator:
-                print("\t Blob name: " + blob.name)
-                blob_client = blob_service_client.get_blob_client(
-                    container=container['name'], blob=blob)
-                #local_path_for_container = os.path.join(local_path,container['name']) 
-                #local_file_path_for_blob = os.path.join(local_path,container['name'],blob.name) 
-                local_file_path_for_blob = os.path.join(local_path,blob.name) 
-                print("\t Local Path for blob: " + local_file_path_for_blob)
-                if os.path.exists(local_file_path_for_blob):
-                    print("[ DEBUG ] File Exist! ")
-                else:
-                    print("[ DEBUG ] File NOT Exist! Update New Image...")
-                    #if not os.path.exists(local_path_for_container):
-                    #    os.makedirs(local_path_for_container)
-                    #    print("[ DEBUG ] Make " + local_path_for_container)
-                    try:
-                        stream = blob_client.download_blob().readall()
-                        file = open(local_file_path_for_blob,'wb+')
-                        file.write(stream)
-                        file.close()
-                    except ResourceNotFoundError:
-                        print("No blob found.")
+        # A single client shares one aiohttp connection pool across all the downloads
+        async with BlobServiceClient.from_connection_string(conn_str=conn_str) as blob_service_client:
+            # Create Sample folder if it not exists, and create a file in folder Sample to test the upload and download.
+            local_path = os.path.join(os.path.expanduser("~"),'Face_Gallery')
+            if not os.path.exists(local_path):
+                os.makedirs(local_path)
+                print("[ DEBUG ] Make " + local_path)
+
+            # Read the gallery directory once instead of a stat() call per blob
+            existing = {entry.name for entry in os.scandir(local_path)}
+            sem = asyncio.Semaphore(MAX_INFLIGHT_DOWNLOADS)
+            # Only record the missing blobs while listing, the download coroutines are created
+            # at gather so a listing error cannot leave them unawaited
+            missing_blobs = []
+            container_clients = {}
+            # List the containers in the Storage Account and blobs in the container
+            async for container in blob_service_client.list_containers(include_metadata=True):
+                print(container['name'], container['metadata'])
+                print("\nList blobs in the container")
+                container_id = container_clients.get(container['name'])
+                if container_id is None:
+                    container_id = blob_service_client.get_container_client(container=container['name'])
+                    container_clients[container['name']] = container_id
+                async for blob in container_id.list_blobs():
+                    print("\t Blob name: " + blob.name)
+                    #local_path_for_container = os.path.join(local_path,container['name'])
+                    #local_file_path_for_blob = os.path.join(local_path,container['name'],blob.name)
+                    local_file_path_for_blob = os.path.join(local_path,blob.name)
+                    print("\t Local Path for blob: " + local_file_path_for_blob)
+                    if blob.name in existing:
+                        print("[ DEBUG ] File Exist! ")
+                    else:
+                        print("[ DEBUG ] File NOT Exist! Update New Image...")
+                        #if not os.path.exists(local_path_for_container):
+                        #    os.makedirs(local_path_for_container)
+                        #    print("[ DEBUG ] Make " + local_path_for_container)
+                        existing.add(blob.name)
+                        missing_blobs.append((container_id, blob.name, local_file_path_for_blob))
+
+            # Download all the missing blobs concurrently on the event loop, waiting for every
+            # download so one failed blob neither aborts the others nor closes the client early
+            results = await asyncio.gather(*(_fetch_blob(container_id, sem, blob_name, dest)
+                                             for container_id, blob_name, dest in missing_blobs),
+                                           return_exceptions=True)
+            for (_, blob_name, _), result in zip(missing_blobs, results):
+                if isinstance(result, BaseException):
+                    print("[ ERROR ] Failed to download " + blob_name + ": " + str(result))
     except Exception as e:
         print(e)
 
+def run_sample(azs_storage):
+    asyncio.run(run_sample_async(azs_storage))
+
 
 # Main method.
 if __name__ == '__main__':
-    run_sample()
\ No newline at end of file
+    run_sample(sys.argv[1])